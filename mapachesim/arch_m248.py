@@ -1,17 +1,5 @@
 from isa import IsaDefinition
 
-#class MemoryConverter:
-#    def __init__(self, isa):
-#        self.isa = isa
-#
-#    def __getitem__(self, address):
-#        # This is very probably wrong.
-#        return self.isa.mem_read(address, self.isa.isize)
-#
-#    def __setitem__(self, address, data):
-#        # See above.
-#        self.isa.mem_write(address, int.to_bytes(data, 1, 'big', signed=True))
-
 class M248(IsaDefinition):
     ''' The tiny riscy 2-operand M248 ISA
     - 2 operands
@@ -48,9 +36,7 @@ class M248(IsaDefinition):
     def instruction_load(self, ifield):
         'load : rrrddd10 : load $r $d'
         self.R[ifield.d] = self.mem_read_8bit(self.R[ifield.r])
-        #self.R[ifield.d] = self.M[self.R[ifield.r]]
 
     def instruction_store(self, ifield):
         'store : rrrddd11 : store $r $d'
         self.mem_write_8bit(self.R[ifield.d], value=self.R[ifield.r])
-        #self.M[self.R[ifield.d]] = self.R[ifield.r]
@@ -2,11 +2,14 @@
 
 import string
 
-from helpers import sign_extend, bit_select, decimalstr_to_int
+from helpers import sign_extend, decimalstr_to_int
 from helpers import ExecutionError, ExecutionComplete
 from isa import IsaDefinition
 from assembler import Assembler
 
+# characters printed as "<?>" by the print string syscall
+unprintable_chars = {c: '<?>' for c in range(256) if chr(c) not in string.printable}
+
 class Mips(IsaDefinition):
     ''' MIPS Instruction Set Definition. '''
     def __init__(self):
@@ -20,22 +23,17 @@ class Mips(IsaDefinition):
             20:'$s4',  21:'$s5',  22:'$s6',  23:'$s7',
             24:'$t8',  25:'$t9',  26:'$k0',  27:'$k1',
             28:'$gp',  29:'$sp',  30:'$fp',  31:'$ra'}
-        self.make_register_file('R', 32, 32, rnames=mips_rnames)
+        self.make_register_file('R', 32, 32, rnames=mips_rnames, zero_register=0)
         self.make_register('PC', 32)
         self.make_register('HI', 32)
         self.make_register('LO', 32)
 
         jumps = 'j jal jr jalr beq'.split()
         self.jumps = set(getattr(self, f'instruction_{jump}') for jump in jumps)
+        self.advance_pc = True  # PC+4 after every instruction not in jumps
         self.endian = 'big'
         self.assembler = Assembler(self)
 
-    def finalize_execution(self, decoded_instruction):
-        ifunction, ifields = decoded_instruction
-        self.R[0] = 0  # keep regisiter 0 value as zero
-        if ifunction not in self.jumps:
-            self.PC = self.PC + 4
-
     def reset_registers(self):
         super().reset_registers()
         self.R[28] = 0x10008000 # same value as SPIM at reset
@@ -82,32 +80,36 @@ class Mips(IsaDefinition):
 
     def instruction_sra(self, ifield):
         'shift right arithmetic : 000000 ----- ttttt ddddd hhhhh 000011: sra $d $t !h'
-        self.R[ifield.d] = sign_extend(self.R[ifield.t],32) >> ifield.h
+        self.R[ifield.d] = ((self.R[ifield.t] ^ 0x80000000) - 0x80000000) >> ifield.h
 
     def instruction_sllv(self, ifield):
         'shift left logical variable : 000000 sssss ttttt ddddd ----- 000100: sllv $d $t $s'
-        self.R[ifield.d] = self.R[ifield.t] << self.R[ifield.s]
+        self.R[ifield.d] = self.R[ifield.t] << (self.R[ifield.s] & 0x1f)
 
     def instruction_srlv(self, ifield):
         'shift right logical variable : 000000 sssss ttttt ddddd ----- 000110: srlv $d $t $s'
-        self.R[ifield.d] = self.R[ifield.t] >> self.R[ifield.s]
+        self.R[ifield.d] = self.R[ifield.t] >> (self.R[ifield.s] & 0x1f)
 
     def instruction_srav(self, ifield):
         'shift right arithmetic variable : 000000 sssss ttttt ddddd ----- 000111: srav $d $t $s'
-        self.R[ifield.d] = sign_extend(self.R[ifield.t],32) >> self.R[ifield.s]
+        self.R[ifield.d] = ((self.R[ifield.t] ^ 0x80000000) - 0x80000000) >> (self.R[ifield.s] & 0x1f)
 
     def instruction_jr(self, ifield):
         'jump register : 000000 sssss ----- ----- ----- 001000: jr $s'
-        self.invalid_when(self.R[ifield.s] % 4 != 0, 'jr: R[$rs] must be a multiple of 4')
-        self.PC = self.R[ifield.s]
+        target = self.R[ifield.s]
+        if target & 3:
+            raise ExecutionError('jr: R[$rs] must be a multiple of 4')
+        self.PC = target
 
     def instruction_jalr(self, ifield):
         'jump-and-link register: 000000 sssss ----- ddddd ----- 001001: jalr $d $s'
-        self.invalid_when(self.R[ifield.s] % 4 != 0, 'jalr: R[$rs] must be a multiple of 4')
-        self.invalid_when(ifield.s == ifield.d, 'jalr: $rs and $rd must be different registers')
-        tmp = self.R[ifield.s]
+        target = self.R[ifield.s]
+        if target & 3:
+            raise ExecutionError('jalr: R[$rs] must be a multiple of 4')
+        if ifield.s == ifield.d:
+            raise ExecutionError('jalr: $rs and $rd must be different registers')
         self.R[ifield.d] = self.PC + 4
-        self.PC = tmp
+        self.PC = target
 
     def instruction_syscall(self, ifield):
         'system call : 000000 ----- ----- ----- ----- 001100: syscall'
@@ -119,16 +121,17 @@ class Mips(IsaDefinition):
         elif self.R[v0] == 4:  # print string
             maxstring = 1024
             address = self.R[a0]
-            printable_chars = bytes(string.printable, 'ascii')
-            for i in range(maxstring):
-                next_byte = self.mem_read(address, 1)
-                if next_byte == b'\x00':
+            end_address = address + maxstring
+            while address < end_address:
+                # read up to the end of the page at a time (reads cannot cross pages)
+                chunk = self.mem_read(address, min(end_address, (address | 0xfff) + 1) - address)
+                nul = chunk.find(0)
+                if nul >= 0:
+                    chunk = chunk[:nul]
+                print(chunk.decode('latin-1').translate(unprintable_chars), end='')
+                if nul >= 0:
                     break
-                elif next_byte in printable_chars:
-                    print(next_byte.decode('ascii'), end='')
-                else:
-                    print('<?>', end='')
-                address += 1
+                address += len(chunk)
             else: # hit the maxstring limit
                     print(f'... (string continues beyond limit of {maxstring})', end='')
 
@@ -170,13 +173,13 @@ class Mips(IsaDefinition):
 
     def instruction_j(self, ifield):
         'jump : 000010 aaaaaaaaaaaaaaaaaaaaaaaaaa : j @a'
-        upper_bits = bit_select(self.PC + 4, 31, 28)
+        upper_bits = (self.PC + 4) & 0xf0000000
         self.PC = upper_bits + (ifield.a << 2)
 
     def instruction_jal(self, ifield):
         'jump and link : 000011 aaaaaaaaaaaaaaaaaaaaaaaaaa : jal @a'
         self.R[31] = self.PC + 4
-        upper_bits = bit_select(self.PC + 4, 31, 28)
+        upper_bits = (self.PC + 4) & 0xf0000000
         self.PC = upper_bits + (ifield.a << 2)
 
     # I-format Instructions
@@ -193,17 +196,17 @@ class Mips(IsaDefinition):
         # TODO: this should be PC-relative addressing! started above, but using absolute for now
         newpc = self.PC + 4
         if self.R[ifield.s] == self.R[ifield.t]:
-            upper_bits = bit_select(self.PC + 4, 31, 18)
+            upper_bits = (self.PC + 4) & 0xfffc0000
             newpc = upper_bits + (ifield.a << 2)
         self.PC = newpc
 
     def instruction_addi(self, ifield):
         'add immediate : 001000 sssss ttttt iiiiiiiiiiiiiiii : addi $t $s !i'
-        self.R[ifield.t] = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        self.R[ifield.t] = self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)
 
     def instruction_addiu(self, ifield):
         'add immediate unsigned : 001001 sssss ttttt iiiiiiiiiiiiiiii : addiu $t $s !i'
-        self.R[ifield.t] = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        self.R[ifield.t] = self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)
 
     def instruction_ori(self, ifield):
         'or immediate : 001101 sssss ttttt iiiiiiiiiiiiiiii : ori $t $s !i'
@@ -216,13 +219,13 @@ class Mips(IsaDefinition):
     def instruction_lw(self, ifield):
         # TODO: add "imm(addr)" format 
         'load word : 100010 sssss ttttt iiiiiiiiiiiiiiii : lw $t !i $s'
-        addr = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        addr = self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)
         self.invalid_when(addr % 4 != 0, 'lw: R[$rs]+immed must be a multiple of 4')
         self.R[ifield.t] = self.mem_read_32bit(addr)
 
     def instruction_sw(self, ifield):
         # TODO: add "imm(addr)" format 
         'store word : 101011 sssss ttttt iiiiiiiiiiiiiiii : sw $t !i $s'
-        addr = self.R[ifield.s] + sign_extend(ifield.i, 16)
+        addr = self.R[ifield.s] + ((ifield.i ^ 0x8000) - 0x8000)
         self.invalid_when(addr % 4 != 0, 'sw: R[$rs]+immed must be a multiple of 4')
         self.mem_write_32bit(addr, value=self.R[ifield.t])
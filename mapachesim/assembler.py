@@ -11,6 +11,7 @@ from helpers import int_to_bitstring, decimalstr_to_int, hexstr_to_int
 from helpers import ISADefinitionError, AssemblyError
 
 asm_id = '[a-zA-Z_][a-zA-Z0-9_]*'
+label_re = re.compile(f'^{asm_id}:$')  # a label definition, e.g. 'main:'
 
 class Assembler:
     def __init__(self, isa):
@@ -24,8 +25,8 @@ class Assembler:
         self.labels = {}  # reset all the labels  TODO: clear the breakpoints?
         tokenized_program = list(self.tokenize(program))
         data = self.assemble_data(tokenized_program, data_start_address)
-        self.set_text_labels(tokenized_program, text_start_address)
-        text = self.assemble_text(tokenized_program)
+        text_instructions = self.set_text_labels(tokenized_program, text_start_address)
+        text = self.assemble_text(text_instructions)
         return text, data, self.labels
 
     def assemble_data(self, tokenized_program, data_start_address):
@@ -80,7 +81,7 @@ class Assembler:
 
     def parse_label(self, label):
         ''' Return the name of the label, raising an error if a problem exists. '''
-        if re.match(f'^{asm_id}:$', label):
+        if label_re.match(label):
             return label[:-1]
         else:
             raise AssemblyError(f'Bad data label at line {self.current_line}.')
@@ -107,20 +108,25 @@ class Assembler:
             raise AssemblyError(f'Unknown data type "{type}" at line {self.current_line}.')
 
     def set_text_labels(self, tokenized_program, text_start_address):
-        ''' Walk the instructions and set the text label addresses. '''
+        ''' Walk the instructions and set the text label addresses.
+            Returns the (line number, instruction) list, pseudos expanded, for assemble_text. '''
+        # labels are set as we go, so pseudos (e.g. la) can refer to earlier text labels
+        text_instructions = []
         instr_number = 0
         for instr in self.instructions(tokenized_program):
-            if re.match(f'^{asm_id}:$', instr[0]):
+            text_instructions.append((self.current_line, instr))
+            if label_re.match(instr[0]):
                 label_name = instr[0][:-1]
                 self.labels[label_name] = instr_number * self.isa.isize + text_start_address
             else:
                 instr_number += 1
+        return text_instructions
 
-    def assemble_text(self, tokenized_program):
-        ''' Given the labels and tokenized program, return a list of bytes for the text segment. '''
+    def assemble_text(self, text_instructions):
+        ''' Given the labels and text instructions, return a list of bytes for the text segment. '''
         instr_bytes = []
-        for instr in self.instructions(tokenized_program):
-            if re.match(f'^{asm_id}:$', instr[0]):
+        for self.current_line, instr in text_instructions:
+            if label_re.match(instr[0]):
                 continue
             coded_instr = self.machine_code(instr)
             instr_bytes.append(coded_instr)
@@ -131,7 +137,7 @@ class Assembler:
         ''' Take a tokenized program and generate lists of token by instruction. '''
         instr = []
         for token in self.segment(tokenized_program, '.text'):
-            if token!=self.END_OF_LINE and re.match(f'^{asm_id}:$', token):
+            if token!=self.END_OF_LINE and label_re.match(token):
                 yield [token]
             elif token is self.END_OF_LINE and instr:
                 if self.is_pseudo(instr):
@@ -74,8 +74,10 @@ class MapacheConsole(cmd.Cmd):
         pc = None
         try:
             while instructions_executed < max_instructions:
-                pc, ireturn = self.machine.step()
-                instructions_executed += 1
+                # run in bounded batches, with run() checking for an interrupt after every step
+                batch = 1 if print_each else min(max_instructions - instructions_executed, 4096)
+                steps, pc, ireturn = self.machine.run(batch, self.breakpoints, lambda: self._interrupted)
+                instructions_executed += steps
                 if self._interrupted:
                     self._interrupted = False
                     stop_string = 'interrupted'
@@ -89,6 +91,7 @@ class MapacheConsole(cmd.Cmd):
                 elif print_each:
                     self.print_instruction(pc)
         except ExecutionError as e:
+            instructions_executed += getattr(e, 'steps', 0)  # steps completed before the error
             pc = self.machine.PC
             stop_string = 'machine error'
             self.print_error(f'Runtime Machine Error: {e}')
@@ -162,17 +165,13 @@ class MapacheConsole(cmd.Cmd):
     def print_memory(self, start_addr, size=256, width=16, sep='  '):
         '''Helper function for printing memory state.'''
 
-        def mformat(rval):
-            return f'{rval:02x}'
-
         try:
             memory = self.machine.mem_read(start_addr, size)
-            mem_formated = [mformat(b) for b in memory]
             print()
             for offset in range(0, size, width):
                 addr = start_addr + offset
-                row = mem_formated[offset:offset+width]
-                mem_words = [' '.join(chunk) for chunk in _chunk_list(row, 4)]
+                row = memory[offset:offset+width]
+                mem_words = [chunk.hex(' ') for chunk in _chunk_list(row, 4)]
                 mem_row = sep.join(mem_words)
                 print(f'{addr:#010x}:{sep}{mem_row}')
             print()
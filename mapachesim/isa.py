@@ -1,14 +1,55 @@
 ''' ISA definition classes. '''
 
-import collections
+import array
+import functools
 import itertools
-import types
+import operator
+import struct
 
 import assembler
-from helpers import ISADefinitionError, AssemblyError, ExecutionError
+from helpers import ISADefinitionError, AssemblyError, ExecutionError, ExecutionComplete
 from helpers import decimalstr_to_int
 
 
+class RegisterFile(array.array):
+    ''' A fixed-size register file whose writes are masked to the register width
+        (and to zero for a hardwired zero register, such as MIPS $0). '''
+    __slots__ = ('masks',)
+
+    def __new__(cls, size, bits, zero_register=None):
+        if bits > 64:
+            raise ISADefinitionError(f'Register files wider than 64 bits ("{bits}") are not supported.')
+        regfile = super().__new__(cls, 'Q', bytes(8*size))
+        regfile.masks = tuple(0 if i == zero_register else (1<<bits)-1 for i in range(size))
+        return regfile
+
+    def __setitem__(self, index, value, _setitem=array.array.__setitem__):
+        _setitem(self, index, value & self.masks[index])
+
+    def reset(self):
+        '''Set every register in the file to zero.'''
+        array.array.__setitem__(self, slice(None), array.array('Q', bytes(8*len(self))))
+
+
+class InstructionFields:
+    ''' Base class for the decoded fields of an instruction (e.g. "ifield.s"). '''
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+def _make_fields_class(name, field_names):
+    '''Generate a subclass of InstructionFields with a slot for each named field.'''
+    body = ''.join(f'    self.{f} = {f}\n' for f in field_names) or '    pass\n'
+    source = f'def __init__({", ".join(["self"] + field_names)}):\n{body}'
+    namespace = {}
+    exec(compile(source, f'<fields {name}>', 'exec'), namespace)
+    attributes = {'__slots__': tuple(field_names), '__init__': namespace['__init__']}
+    return type(f'{name}_fields', (InstructionFields,), attributes)
+
+
 class  IsaDefinition:
     ''' A base class for defining ISAs. '''
 
@@ -16,7 +57,13 @@ class  IsaDefinition:
         self._instrfuncs = [getattr(self,f) for f in dir(self) if f.startswith('instruction_')]
         self._pseudofuncs = [getattr(self,f) for f in dir(self) if f.startswith('pseudo_')]
         self._reg_list = []
-        self._mem = {}  # a dictionary of 4k bytearrays
+        self._regnum_from_name = {}  # register name (e.g. '$t0') -> register number
+        self._pattern_cache = {}  # function name -> bit pattern from its docstring
+        self._asm_cache = {}  # function name -> asm format from its docstring
+        self._pages = []  # page table of 4k bytearrays indexed by page number (None if unmapped)
+        self._labels_by_addr = {}  # reverse of the last label table passed to disassemble
+        self._labels_by_addr_source = None
+        self._labels_by_addr_len = 0
 
         # the parameters below are set by default but can be overridden in derived classes
         self.endian = 'big'  # can be either 'big' or 'little'
@@ -24,9 +71,30 @@ class  IsaDefinition:
         self.text_start_address = 0x10000
         self.data_start_address = 0x40000
         self.stack_start_address = 0x7fe00000
+        self.advance_pc = False  # if True, PC moves ahead by isize after each instruction not in jumps
+        self.jumps = set()  # instruction functions that set the PC themselves
         self.assembler = assembler.Assembler(self)
         # try and catch some common errors early
         self.sanity_check()
+        # precompute the decode tables (kept as parallel lists indexed by instruction)
+        patterns = [self._extract_pattern(f) for f in self._instrfuncs]
+        fixed_bits = [self._fixed_bits(p) for p in patterns]
+        self._masks = [mask for mask, match in fixed_bits]
+        self._matches = [match for mask, match in fixed_bits]
+        # bucket the instructions by the leading bits that every pattern fixes (the opcode)
+        prefix_len = 0
+        while prefix_len < self.isize*8 and all(p[prefix_len] in '01' for p in patterns):
+            prefix_len += 1
+        self._prefix_shift = self.isize*8 - prefix_len
+        buckets = {}  # opcode bits -> indices of the instructions with that opcode
+        for i, match in enumerate(self._matches):
+            buckets.setdefault(match >> self._prefix_shift, []).append(i)
+        # and generate a specialized decoder for each bucket
+        self._dispatch = {prefix: self._make_decoder(indices) for prefix, indices in buckets.items()}
+        self._formatters = {f: self._make_formatter(f) for f in self._instrfuncs}
+        self._decode_cache = {}  # instruction (as an integer) -> (ifunc, ifield)
+        self._pc_cache = [None] * 4096  # direct-mapped by PC, each slot is (pc, decoded instr)
+        self.invalidate_decode_cache()
 
     def sanity_check(self):
         '''Run a series of checks for common errors in ISA specification.'''
@@ -40,26 +108,48 @@ class  IsaDefinition:
                 def_op = self._extract_asm(getattr(self,f)).split()[0]
                 if func_op != def_op:
                     raise ISADefinitionError(f'{f} name "{func_op}" and def "{def_op}" differ.')
-        # check that all bitpatterns are pairwise unique
-        for f1, f2 in itertools.combinations(self._instrfuncs, 2):
-            p1 = self._extract_pattern(f1)
-            p2 = self._extract_pattern(f2)
-            differ = lambda x,y: (x=='0' and y=='1') or (x=='1' and y=='0')
-            differ_by_at_least_one_bit = any(differ(x,y) for x,y in zip(p1,p2))
-            if not differ_by_at_least_one_bit:
+        # check that all bitpatterns are pairwise unique (differ in at least one fixed bit)
+        patterns = [self._extract_pattern(f) for f in self._instrfuncs]
+        fixed_bits = {p: self._fixed_bits(p) for p in patterns}
+        for p1, p2 in itertools.combinations(patterns, 2):
+            (mask1, match1), (mask2, match2) = fixed_bits[p1], fixed_bits[p2]
+            if mask1 & mask2 & (match1 ^ match2) == 0:
                 raise ISADefinitionError(f'Patterns "{p1}" and "{p2}" overlap.')
 
+    @property
+    def endian(self):
+        '''The byte order of the machine, either 'big' or 'little'.'''
+        return self._endian
+
+    @endian.setter
+    def endian(self, endian):
+        '''Set the byte order, selecting matching struct codecs for the memory helpers.'''
+        if endian not in ('big', 'little'):
+            raise ISADefinitionError(f'Unknown endianness "{endian}".')
+        byte_order = '>' if endian == 'big' else '<'
+        self._endian = endian
+        self._s64 = struct.Struct(byte_order + 'q')
+        self._s32 = struct.Struct(byte_order + 'i')
+        self._s16 = struct.Struct(byte_order + 'h')
+        self._s8 = struct.Struct(byte_order + 'b')
+        # unsigned codecs for reading whole instructions, by instruction size
+        self._instr_codecs = {size: struct.Struct(byte_order + fmt)
+                              for size, fmt in ((1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q'))}
+
     def make_register(self, name, bits=32):
         '''Add a special purpose register to the machine specification.'''
         setattr(self, name, 0)
         self._reg_list.append(('reg',name,bits,None,None))
 
-    def make_register_file(self, name, size, bits=32, rnames=None):
-        '''Add a register file to the machine specification.'''
-        setattr(self, name, {x:0 for x in range(size)})
+    def make_register_file(self, name, size, bits=32, rnames=None, zero_register=None):
+        '''Add a register file to the machine specification.
+           Writes to zero_register (if given) are ignored, so it always reads as zero.'''
+        setattr(self, name, RegisterFile(size, bits, zero_register))
         if rnames is None:
             rnames = {x:f'${name}{x}' for x in range(size)}
         self._reg_list.append(('file',name,bits,size,rnames))
+        for rnum, register_name in rnames.items():
+            self._regnum_from_name.setdefault(register_name, rnum)
 
     def registers(self):
         '''Generates a triple of information for each register (name, bitwidth, value).'''
@@ -68,8 +158,8 @@ class  IsaDefinition:
                 yield name, bits, getattr(self, name)
             else:
                 assert rtype=='file'
-                for i in range(size):
-                    yield rnames[i], bits, getattr(self, name)[i]
+                for i, value in enumerate(getattr(self, name)):
+                    yield rnames[i], bits, value
 
     def reset_registers(self):
         '''Reset all of the registers to zero.'''
@@ -78,33 +168,24 @@ class  IsaDefinition:
                 setattr(self, name, 0)
             else:
                 assert rtype=='file'
-                for i in range(size):
-                    getattr(self, name)[i] = 0
+                getattr(self, name).reset()
 
     def bitclip_registers(self):
-        '''Mask all the registers back to their values.'''
-        # TODO: this should be handled with a specific register class
-        # because doing this after every instruction seems wasteful
+        '''Mask the special purpose registers back to their widths.'''
+        # register files mask their values as they are written, so only the (few)
+        # special purpose registers need clipping after each instruction
         for rtype, name, bits, size, rnames in self._reg_list:
-            mask = (1<<bits)-1
             if rtype=='reg':
-                clipped_value = getattr(self, name) & mask
+                clipped_value = getattr(self, name) & ((1<<bits)-1)
                 setattr(self, name, clipped_value)
-            else:
-                assert rtype=='file'
-                for i in range(size):
-                    clipped_value = getattr(self, name)[i] & mask
-                    getattr(self, name)[i] = clipped_value
 
     def register_number_from_name(self, name_in_code):
         '''Return register number (an int) from name provided.
            If the name is not found it will check for $number format (e.g. $8).
            If it cannot provide a number, it will return None.'''
-        for rtype,name,bits,size,rname in self._reg_list:
-            if rtype=='file':
-                for rnum,register_name in rname.items():
-                    if register_name==name_in_code:
-                        return rnum
+        rnum = self._regnum_from_name.get(name_in_code)
+        if rnum is not None:
+            return rnum
         # can't find name, maybe it is a number directly
         if name_in_code.startswith('$'):
             return decimalstr_to_int(name_in_code[1:])
@@ -119,13 +200,15 @@ class  IsaDefinition:
         '''Fetch the next instruction at PC and return as an array of bytes.'''
         return self.mem_read(self.PC, self.isize)
 
+    def fetch_instruction_int(self):
+        '''Fetch the next instruction at PC and return it as an (unsigned) integer.'''
+        return self.mem_read_instruction(self.PC)
+
     def decode(self, instr):
         '''Given an instruction (as array of bytes) return its decoded form.'''
-        ifunc, ifield = self._find_pattern_match(instr)
-        if ifunc:
-            return ifunc, ifield
-        else:
-            raise ExecutionError(f'Unable to decode bytes as instruction: "{instr}".')
+        if len(instr) != self.isize:
+            raise ISADefinitionError(f'instruction "{instr}" is {len(instr)} bytes not {self.isize}.')
+        return self._decode_int(int.from_bytes(instr, self.endian))
 
     def execute(self, decoded_instr):
         '''Execute a decoded instruction.'''
@@ -146,20 +229,70 @@ class  IsaDefinition:
         ifunction, ifield = self._find_pattern_match(instr)
         if not ifunction:
             return None
-        asm_pattern = self._extract_asm(ifunction)
-        instr_string = self._format_asm(asm_pattern, ifield, labels)
+        instr_string = self._formatters[ifunction](ifield, labels)
         return instr_string
 
     def step(self):
         '''Step the simulator forward and return any information from execution.'''
         executed_pc = self.PC
-        instr_mem = self.fetch()
-        decoded_instr = self.decode(instr_mem)
+        decoded_instr = self._fetch_and_decode()
         ireturn = self.execute(decoded_instr)
+        if self.advance_pc and decoded_instr[0] not in self.jumps:
+            self.PC = self.PC + self.isize
         if hasattr(self,'finalize_execution'):
             self.finalize_execution(decoded_instr)
         return executed_pc, ireturn
 
+    def run(self, max_steps, breakpoints=(), interrupted=None):
+        '''Step the simulator up to max_steps times, stopping early at a breakpoint,
+           when execution completes, or when interrupted() (checked after every step)
+           returns true.  Returns (steps, last executed pc, ireturn).  An ExecutionError
+           raised part way through carries the number of steps completed as e.steps.'''
+        # bind the per-step methods once rather than looking them up every instruction
+        fetch_and_decode, execute = self._fetch_and_decode, self.execute
+        finalize = getattr(self, 'finalize_execution', None)
+        pc_cache = self._pc_cache
+        # unless execute is overridden, inline it (and the special register clipping)
+        inline_execute = type(self).execute is IsaDefinition.execute
+        state = self.__dict__
+        clip = [(name, (1<<bits)-1) for rtype, name, bits, size, rnames in self._reg_list if rtype=='reg']
+        jumps = self.jumps if self.advance_pc else None
+        isize = self.isize
+        steps, executed_pc, ireturn = 0, None, None
+        try:
+            while steps < max_steps:
+                executed_pc = state['PC']
+                entry = pc_cache[(executed_pc >> 2) & 0xfff]
+                if entry is not None and entry[0] == executed_pc:
+                    decoded_instr = entry[1]
+                else:
+                    decoded_instr = fetch_and_decode()
+                if inline_execute:
+                    ireturn = decoded_instr[0](decoded_instr[1])
+                    for name, mask in clip:
+                        state[name] &= mask
+                else:
+                    ireturn = execute(decoded_instr)
+                if jumps is not None and decoded_instr[0] not in jumps:
+                    state['PC'] += isize
+                if finalize is not None:
+                    finalize(decoded_instr)
+                steps += 1
+                if state['PC'] in breakpoints or ireturn is ExecutionComplete:
+                    break
+                if interrupted is not None and interrupted():
+                    break
+        except ExecutionError as e:
+            e.steps = steps
+            raise
+        return steps, executed_pc, ireturn
+
+    def invalidate_decode_cache(self):
+        '''Forget all instructions decoded by PC (needed only if code in memory changes).'''
+        self._pc_cache[:] = [None] * len(self._pc_cache)
+        # the range of addresses holding cached instructions, used to spot writes to code
+        self._pc_cache_low, self._pc_cache_high = float('inf'), 0
+
     def mem_map(self, start_address, size):
         '''Map a region of physical memory into the simulator.'''
         # TODO: page size be configurable by the isa
@@ -167,154 +300,259 @@ class  IsaDefinition:
         self.invalid_when(size & 0xfff, 'Memory size is not 4k page aligned' )
         self.invalid_when(size <= 0, 'Non-positive memory allocation size' )
         self.invalid_when(start_address < 0, 'Negative start address' )
-        for page in range(start_address, start_address+size, 4096):
-            self.invalid_when(page in self._mem, 'Attempted to map page which is already mapped' )
-            self._mem[page] = bytearray(4096)
+        last_page_number = (start_address + size - 1) >> 12
+        if last_page_number >= len(self._pages):
+            self._pages.extend([None] * (last_page_number + 1 - len(self._pages)))
+        for page_number in range(start_address >> 12, last_page_number + 1):
+            self.invalid_when(self._pages[page_number] is not None, 'Attempted to map page which is already mapped' )
+            self._pages[page_number] = bytearray(4096)
 
     def mem_read(self, start_addr, size):
         '''Read a region of memory and return an array of bytes.'''
         if size <= 0:
             raise ISADefinitionError(f'Memory read of size "{size}" not supported')
-        page, offset = start_addr & ~0xfff, start_addr & 0xfff
-        end_page = (start_addr + size - 1) & ~0xfff
-        self.invalid_when(page != end_page, f'Memory read across page boundries not supported' )
-        self.invalid_when(page not in self._mem, f'Segmentation Fault (access to unmapped page "{hex(page)}")' )
-        return self._mem[page][offset:offset+size]
+        page_data, offset = self._locate(start_addr, size, 'read')
+        return page_data[offset:offset+size]
 
     def mem_write(self, start_addr, data):
         '''Write an array of bytes into memory.'''
-        page, offset = start_addr & ~0xfff, start_addr & 0xfff
         size = len(data)
-        end_page = (start_addr + size - 1) & ~0xfff
-        self.invalid_when(page != end_page, f'Memory write across page boundries not supported' )
-        self.invalid_when(page not in self._mem, f'Segmentation Fault (access to unmapped page "{hex(page)}")' )
-        self._mem[page][offset:offset+size] = data
+        page_data, offset = self._locate(start_addr, size, 'write')
+        page_data[offset:offset+size] = data
+        if start_addr < self._pc_cache_high and start_addr + size > self._pc_cache_low:
+            self.invalidate_decode_cache()
 
     def mem_write_64bit(self, start_addr, value):
-        self.mem_write(start_addr, int.to_bytes(value, 8, self.endian, signed=True))
+        self._mem_pack(self._s64, start_addr, value)
     def mem_write_32bit(self, start_addr, value):
-        self.mem_write(start_addr, int.to_bytes(value, 4, self.endian, signed=True))
+        self._mem_pack(self._s32, start_addr, value)
     def mem_write_16bit(self, start_addr, value):
-        self.mem_write(start_addr, int.to_bytes(value, 2, self.endian, signed=True))
+        self._mem_pack(self._s16, start_addr, value)
     def mem_write_8bit(self, start_addr, value):
-        self.mem_write(start_addr, int.to_bytes(value, 1, self.endian, signed=True))
+        self._mem_pack(self._s8, start_addr, value)
     def mem_read_64bit(self, start_addr):
-        return int.from_bytes(self.mem_read(start_addr, 8), self.endian, signed=True)
+        page_data, offset = self._locate(start_addr, 8, 'read')
+        return self._s64.unpack_from(page_data, offset)[0]
     def mem_read_32bit(self, start_addr):
-        return int.from_bytes(self.mem_read(start_addr, 4), self.endian, signed=True)
+        page_data, offset = self._locate(start_addr, 4, 'read')
+        return self._s32.unpack_from(page_data, offset)[0]
     def mem_read_16bit(self, start_addr):
-        return int.from_bytes(self.mem_read(start_addr, 2), self.endian, signed=True)
+        page_data, offset = self._locate(start_addr, 2, 'read')
+        return self._s16.unpack_from(page_data, offset)[0]
     def mem_read_8bit(self, start_addr):
-        return int.from_bytes(self.mem_read(start_addr, 1), self.endian, signed=True)
+        page_data, offset = self._locate(start_addr, 1, 'read')
+        return self._s8.unpack_from(page_data, offset)[0]
     def mem_read_instruction(self, start_addr):
-        return int.from_bytes(self.mem_read(start_addr, self.isize), self.endian, signed=False)
-        
+        '''Read the instruction at start_addr and return it as an (unsigned) integer.'''
+        page_data, offset = self._locate(start_addr, self.isize, 'read')
+        codec = self._instr_codecs.get(self.isize)
+        if codec is not None:
+            return codec.unpack_from(page_data, offset)[0]
+        return int.from_bytes(page_data[offset:offset+self.isize], self.endian, signed=False)
+
 
     #--- private methods -------------------------------------------------------------
 
+    def _locate(self, start_addr, size, access):
+        '''Return the page (a bytearray) and offset of a region of memory, raising
+           ExecutionError if the region is unmapped or crosses a page boundry.'''
+        page_number, offset = start_addr >> 12, start_addr & 0xfff
+        if offset + size > 0x1000:
+            raise ExecutionError(f'Memory {access} across page boundries not supported')
+        page_data = self._pages[page_number] if 0 <= page_number < len(self._pages) else None
+        if page_data is None:
+            raise ExecutionError(f'Segmentation Fault (access to unmapped page "{hex(page_number << 12)}")')
+        return page_data, offset
+
+    def _mem_pack(self, codec, start_addr, value):
+        '''Pack value into memory in place using the given struct codec.'''
+        page_data, offset = self._locate(start_addr, codec.size, 'write')
+        codec.pack_into(page_data, offset, value)
+        if start_addr < self._pc_cache_high and start_addr + codec.size > self._pc_cache_low:
+            self.invalidate_decode_cache()
+
     def _extract_pattern(self, func):
         '''Extract an patterns from the instruction function docstring.'''
         # string should look like 'add immediate : 001000 sssss ttttt iiiiiiiiiii: something'
-        # TODO: this should probably be done once at initialization
-        docstring = func.__doc__
-        clean_format = docstring.replace(' ','').split(':')[1]
+        clean_format = self._pattern_cache.get(func.__name__)
+        if clean_format is None:
+            docstring = func.__doc__
+            clean_format = docstring.replace(' ','').split(':')[1]
+            self._pattern_cache[func.__name__] = clean_format
         if len(clean_format) != self.isize*8:
             raise ISADefinitionError(f'format for "{clean_format}" is {len(clean_format)} bits not {self.isize*8}.')
         return clean_format
 
+    def _fixed_bits(self, pattern):
+        '''Return a mask of the fixed (0 or 1) bits of a pattern, and the value of those bits.'''
+        mask = int(''.join('1' if b in '01' else '0' for b in pattern), 2)
+        match = int(''.join('1' if b=='1' else '0' for b in pattern), 2)
+        return mask, match
+
+    def _fetch_and_decode(self):
+        '''Return the decoded instruction at PC, using the PC-indexed cache when possible.'''
+        pc = self.PC
+        # the slot ignores the low 2 bits (always zero for 4-byte instructions); the full
+        # pc is still checked so this stays correct for other instruction sizes
+        slot = (pc >> 2) & 0xfff
+        entry = self._pc_cache[slot]
+        if entry is not None and entry[0] == pc:
+            return entry[1]
+        decoded_instr = self._decode_int(self.fetch_instruction_int())
+        self._pc_cache[slot] = (pc, decoded_instr)
+        self._pc_cache_low = min(self._pc_cache_low, pc)
+        self._pc_cache_high = max(self._pc_cache_high, pc + self.isize)
+        return decoded_instr
+
     def _find_pattern_match(self, instr):
         '''Given an instruction (as array of bytes) find and return it's function and field.'''
-        for ifunc in self._instrfuncs:
-            ifield = self._pattern_match(ifunc, instr)
-            if ifield is not None:
-                return ifunc, ifield
-        return None, None
-
-    def _pattern_match(self, ifunc, instr):
-        '''Check if a function docstring matches the raw bytes of instr provided, return fields or None.'''
         if len(instr) != self.isize:
             raise ISADefinitionError(f'instruction "{instr}" is {len(instr)} bytes not {self.isize}.')
+        return self._find_pattern_match_int(int.from_bytes(instr, self.endian))
+
+    def _find_pattern_match_int(self, instr_int):
+        '''Given an instruction (as an integer) find and return it's function and field.'''
+        decoder = self._dispatch.get(instr_int >> self._prefix_shift)
+        if decoder is None:
+            return None, None
+        return decoder(instr_int)
+
+    def _decode_int(self, instr_int):
+        '''Given an instruction (as an integer) return its decoded form, memoizing the result.'''
+        decoded_instr = self._decode_cache.get(instr_int)
+        if decoded_instr is not None:
+            return decoded_instr
+        ifunc, ifield = self._find_pattern_match_int(instr_int)
+        if ifunc is None:
+            raise ExecutionError(f'Unable to decode instruction: "{instr_int:#0{2+2*self.isize}x}".')
+        # ifield only holds ints, so a decoded instruction can be safely reused
+        if len(self._decode_cache) >= 8192:
+            self._decode_cache.clear()
+        decoded_instr = self._decode_cache[instr_int] = (ifunc, ifield)
+        return decoded_instr
+
+    def _make_decoder(self, indices):
+        '''Generate a decoder for the given instructions, which takes an instruction as an
+           integer and returns its function and fields (or None, None if none match).
+           The masks, match values, and field extraction are all inlined as constants.'''
+        # if the instructions share more fixed bits (e.g. a MIPS function code) which tell
+        # them apart, dispatch on those bits first rather than testing each in turn
+        common_mask = functools.reduce(operator.and_, (self._masks[i] for i in indices))
+        subbuckets = {}
+        for i in indices:
+            subbuckets.setdefault(self._matches[i] & common_mask, []).append(i)
+        if len(indices) > 2 and len(subbuckets) > 1:
+            table = {key: self._make_decoder(sub) for key, sub in subbuckets.items()}
+            def decoder(instr):
+                subdecoder = table.get(instr & common_mask)
+                if subdecoder is None:
+                    return None, None
+                return subdecoder(instr)
+            return decoder
+        lines = ['def decoder(instr):']
+        namespace = {}
+        for i in indices:
+            ifunc = self._instrfuncs[i]
+            fields = self._field_extracts(ifunc)
+            namespace[ifunc.__name__] = ifunc
+            namespace[f'{ifunc.__name__}_fields'] = _make_fields_class(ifunc.__name__, list(fields))
+            lines.append(f'    if (instr & {self._masks[i]:#x}) == {self._matches[i]:#x}:')
+            lines.append(f'        return {ifunc.__name__}, {ifunc.__name__}_fields({", ".join(fields.values())})')
+        lines.append('    return None, None')
+        source = '\n'.join(lines) + '\n'
+        exec(compile(source, f'<decoder {self._instrfuncs[indices[0]].__name__}>', 'exec'), namespace)
+        return namespace['decoder']
+
+    def _field_extracts(self, ifunc):
+        '''Return a dict mapping each field of ifunc to source which extracts it from instr.'''
         pattern = self._extract_pattern(ifunc)
-        instr_as_integer = int.from_bytes(instr, self.endian)
-        instr_as_list_of_bits = [(instr_as_integer>>(s-1)) & 0x1 for s in range(self.isize*8,0,-1)]
-        fields = collections.defaultdict(int)
-
-        for bpattern, bit in zip(pattern, instr_as_list_of_bits):
-            if bpattern=='0' and bit==1:
-                return None
-            elif bpattern=='1' and bit==0:
-                return None
-            elif bpattern!='-':
-                fields[bpattern] = (fields[bpattern] << 1) | bit
-        ifield = types.SimpleNamespace(**fields)
-        return ifield
+        nbits = len(pattern)
+        # build an extraction expression per field, one shift-and-mask per run of adjacent bits
+        fields = {}
+        position = 0
+        for bpattern, run in itertools.groupby(pattern):
+            width = len(list(run))
+            position += width
+            if bpattern in '01-':
+                continue
+            if not bpattern.isidentifier():
+                raise ISADefinitionError(f'Invalid field name "{bpattern}" in pattern "{pattern}".')
+            extract = f'((instr >> {nbits-position}) & {(1<<width)-1:#x})'
+            if bpattern in fields:
+                extract = f'({fields[bpattern]} << {width}) | {extract}'
+            fields[bpattern] = extract
+        return fields
 
     def _extract_asm(self, ifunction):
         '''Given an instruction_func, return a clean asm definition from docstring.'''
-        asm_pattern = ifunction.__doc__.split(':')[2]
-        clean_pattern = asm_pattern.replace(',',' ').strip()
-        monospaced_pattern = str.join(' ', clean_pattern.split())
+        monospaced_pattern = self._asm_cache.get(ifunction.__name__)
+        if monospaced_pattern is None:
+            asm_pattern = ifunction.__doc__.split(':')[2]
+            clean_pattern = asm_pattern.replace(',',' ').strip()
+            monospaced_pattern = str.join(' ', clean_pattern.split())
+            self._asm_cache[ifunction.__name__] = monospaced_pattern
         return monospaced_pattern
 
-    def _format_asm(self, asm_pattern, ifield, labels):
-        ''' Return a string of the pattern filled with the field data.'''
-
-        def operand_field(part, indicator):
-            # TODO much better error handling
-            fchar = part[1:]
-            assert len(fchar)==1
-            return getattr(ifield, fchar)
-
-        def label_string(addr):
-            if labels:
-                for label, laddr in labels.items():
-                    if addr == laddr:
-                        return f'{{{label}}}'
-            return ''
-
+    def _make_formatter(self, ifunc):
+        '''Generate a function, specialized to the asm format of ifunc, which takes the
+           instruction fields (and optionally labels) and returns the assembly string.'''
+        asm_pattern = self._extract_asm(ifunc)
+        operand_formats = {
+            '$': '${{f.{0}}}',  # register
+            '@': '{{f.{0} << 2:#x}}{{label_string(f.{0} << 2, labels)}}',  # word address
+            '&': '{{f.{0}:#x}}',  # byte address
+            '^': '+{{f.{0} << 2:#x}}',  # PC-relative word address (not supported yet)
+            '!': '{{f.{0}}}',  # immediate
+            }
         instruction = []
         for i,part in enumerate(asm_pattern.split()):
             if i==0:
                 instruction.append(part)  # instruction name
-            elif part.startswith('$'):
-                # register
-                rnum = operand_field(part, '$')
-                instruction.append(f'${rnum}')
-            elif part.startswith('@'):
-                # word address
-                addr = operand_field(part, '@') << 2
-                label = label_string(addr)
-                instruction.append(f'{hex(addr)}{label}')
-            elif part.startswith('&'):
-                # byte address
-                addr = operand_field(part, '&')
-                instruction.append(f'{hex(addr)}')
-            elif part.startswith('^'):
-                # PC-relative word address (not supported yet)
-                addr = operand_field(part, '^')
-                instruction.append(f'+{hex(addr<<2)}')
-            elif part.startswith('!'):
-                # immediate
-                immed = operand_field(part, '!')
-                instruction.append(f'{immed}')
+            elif part[0] in operand_formats:
+                fchar = part[1:]
+                if not (len(fchar)==1 and fchar.isidentifier()):
+                    raise ISADefinitionError(f'Bad operand field "{part}" in "{asm_pattern}"')
+                instruction.append(operand_formats[part[0]].format(fchar))
             else:
                 raise ISADefinitionError(f'Unknown operand specifier: "{part}" in "{asm_pattern}"')
-        return str.join(' ', instruction)
+        source = (f'def formatter(f, labels=None):\n'
+                  f'    return f\'{" ".join(instruction)}\'\n')
+        namespace = {'label_string': self._label_string}
+        exec(compile(source, f'<formatter {ifunc.__name__}>', 'exec'), namespace)
+        return namespace['formatter']
+
+    def _label_string(self, addr, labels):
+        '''Return the label (in braces) for the given address, or an empty string.'''
+        if labels:
+            # the length check catches labels added to or removed from the same table in place
+            if labels is not self._labels_by_addr_source or len(labels) != self._labels_by_addr_len:
+                # rebuild the reverse map (address -> first label at that address)
+                self._labels_by_addr = {}
+                for label, laddr in labels.items():
+                    self._labels_by_addr.setdefault(laddr, label)
+                self._labels_by_addr_source = labels
+                self._labels_by_addr_len = len(labels)
+            label = self._labels_by_addr.get(addr)
+            if label is not None:
+                return f'{{{label}}}'
+        return ''
 
     def _as_instruction_bytes(self, machine_code_instruction):
         '''Covert the given integer, or hex string to bytes.
            Will raise ValueError if it fails.'''
         instr = machine_code_instruction
+        if isinstance(instr,int) and 0 <= instr < 1 << (self.isize*8):
+            return instr.to_bytes(self.isize, byteorder=self.endian)
         try:
-            if isinstance(instr,int):
-                retval = instr.to_bytes(self.isize, byteorder=self.endian)
-            elif isinstance(instr,str):
+            if isinstance(instr,str):
                 instr_as_int = int(instr, 16)
                 retval = instr_as_int.to_bytes(self.isize, byteorder=self.endian)
-            elif isinstance(instr,bytearray):
+            elif isinstance(instr,(bytes,bytearray)):
                 retval = bytes(instr)
-        except [OverflowError, ValueError]:
+            else:
                 raise ValueError('Unable to covert to bytes')
+        except (OverflowError, ValueError):
+            raise ValueError('Unable to covert to bytes')
         if len(retval) != self.isize:
             raise ValueError('Unable to covert to bytes')
         return retval